@@ -18,9 +18,10 @@ class NoisyMNIST(MNIST):
         train=True,
         entropy=None,
     ):
+        # Tensor-only transforms, applied directly to the decoded uint8 images.
         transform = transforms.Compose(
             [
-                transforms.ToTensor(),
+                transforms.ConvertImageDtype(torch.float32),
                 transforms.Normalize((0.5,), (0.5,)),
             ]
         )
@@ -48,16 +49,17 @@ class NoisyMNIST(MNIST):
         # Get all indices with label 1. Select num_per_class elements of that.
         num_images_per_class = dataset_size // 10
 
-        images, targets = [], []
-        for i in range(10):
-            indices = np.random.choice(
-                (self.targets == i).nonzero().squeeze(),
-                num_images_per_class,
-                replace=False,
-            )
-            images.append(self.data[indices])
-            targets.append(self.targets[indices])
-        self.data, self.targets = torch.cat(images), torch.cat(targets)
+        targets = self.targets.numpy()
+        indices = np.concatenate(
+            [
+                np.random.choice(
+                    np.flatnonzero(targets == i), num_images_per_class, replace=False
+                )
+                for i in range(10)
+            ]
+        )
+        indices = torch.from_numpy(indices)
+        self.data, self.targets = self.data[indices], self.targets[indices]
 
         # Uniform categorical distribution.
         distribution = Categorical(torch.ones(10))
@@ -81,3 +83,10 @@ class NoisyMNIST(MNIST):
         self.targets[indices] = torch.from_numpy(noisy_targets)
 
         assert dataset_size == self.data.shape[0] == self.targets.shape[0] == len(self)
+
+        # The transforms are deterministic, so apply them once to the whole subset
+        # instead of on every access.
+        self.images = self.transform(self.data.unsqueeze(1))
+
+    def __getitem__(self, index):
+        return self.images[index], int(self.targets[index])
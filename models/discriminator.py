@@ -29,12 +29,18 @@ class Discriminator(nn.Module):
 
 
 class ConditionalDiscriminator(nn.Module):
-    def __init__(self, num_in_channels, num_features):
+    def __init__(self, num_in_channels, num_classes, num_features):
         super().__init__()
 
+        # The class condition is projected to a per-class bias on the first feature map
+        # rather than concatenated to the image as constant one-hot planes.
+        self.conv = nn.Conv2d(num_in_channels, num_features, 4, 2, 1, bias=False)
+        self.embedding = nn.Linear(num_classes, num_features, bias=False)
+        # Same scale as the conv weights that used to see the one-hot planes, which
+        # utils.weights_init does not cover for Linear layers.
+        nn.init.normal_(self.embedding.weight, 0.0, 0.02)
+
         self.main = nn.Sequential(
-            # nn.AdaptiveAvgPool2d(64),
-            nn.Conv2d(num_in_channels, num_features, 4, 2, 1, bias=False),
             nn.LeakyReLU(0.2, inplace=True),
             nn.Conv2d(num_features, num_features * 2, 4, 2, 1, bias=False),
             nn.BatchNorm2d(num_features * 2),
@@ -47,9 +53,9 @@ class ConditionalDiscriminator(nn.Module):
             nn.LeakyReLU(0.2, inplace=True),
             nn.Conv2d(num_features * 8, 1, 4, 1, 1, bias=False),
             nn.Flatten(),
-            nn.Sigmoid(),
         )
 
-    def forward(self, input):
-        probs = self.main(input).squeeze()
-        return probs
+    def forward(self, input, one_hot_labels):
+        x = self.conv(input) + self.embedding(one_hot_labels)[..., None, None]
+        logits = self.main(x).squeeze()
+        return logits
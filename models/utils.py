@@ -33,3 +33,41 @@ def get_mnist_transform():
             transforms.Normalize((0.5,), (0.5,)),
         ]
     )
+
+
+class ScalarBuffer:
+    """Collects scalar tensors on the device and writes them to tensorboard in bulk.
+
+    Calling .item() on every logged value synchronizes with the GPU each step, so the
+    values are only copied to the host, all at once, when the buffer is flushed.
+    """
+
+    def __init__(self, writer, tags, capacity, device):
+        self.writer = writer
+        self.tags = tags
+        self.values = torch.empty((capacity, len(tags)), device=device)
+        self.steps = []
+
+    def add(self, step, *values):
+        if len(self.steps) == len(self.values):
+            self.flush()
+        self.values[len(self.steps)] = torch.stack([v.detach().float() for v in values])
+        self.steps.append(step)
+
+    def flush(self):
+        """Write the pending values to tensorboard and return the most recent ones."""
+        if not self.steps:
+            return None
+
+        rows = self.values[: len(self.steps)].tolist()
+        for step, row in zip(self.steps, rows):
+            for tag, value in zip(self.tags, row):
+                self.writer.add_scalar(tag, value, step)
+        self.steps = []
+
+        return rows[-1]
+
+
+def state_dict_to_cpu(module):
+    """Copy the state dict to the CPU so it can be saved while training continues."""
+    return {k: v.to("cpu", copy=True) for k, v in module.state_dict().items()}
@@ -1,5 +1,6 @@
 """Script for pretraining the generator and discriminator networks."""
 import argparse
+import concurrent.futures
 import os
 import random
 import torch
@@ -20,6 +21,10 @@ from models.discriminator import ConditionalDiscriminator
 from models import utils
 
 
+# Writes sample images and checkpoints to disk in the background.
+_saver = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
 def main(args):
     if args.logdir is None:
         args.logdir = f"./pretrain/dataset_size={args.dataset_size},noise_level={args.noise_level}"
@@ -36,36 +41,65 @@ def main(args):
 
     dataset = NoisyMNIST(args.dataset_size, args.noise_level, args.dataroot)
     dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers
+        dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+        pin_memory=device == "cuda",
+        persistent_workers=args.num_workers > 0,
+        drop_last=args.compile,
     )
+    steps_per_epoch = len(dataloader)
 
-    # Conditional Generator Network,
+    # Conditional Generator Network, kept in channels_last like the real images so
+    # that cuDNN can use its NHWC kernels.
     netG = ConditionalGenerator(
         dataset.num_classes,
         args.nz,
         args.ngf,
         dataset.num_channels,
         dataset.output_shape,
-    ).to(device)
+    ).to(device, memory_format=torch.channels_last)
     netG.apply(utils.weights_init)
     if args.netG != "":
         netG.load_state_dict(torch.load(args.netG))
 
     # Conditional Discriminator Network.
     netD = ConditionalDiscriminator(
-        dataset.num_channels + dataset.num_classes, args.ndf
-    ).to(device)
+        dataset.num_channels, dataset.num_classes, args.ndf
+    ).to(device, memory_format=torch.channels_last)
     netD.apply(utils.weights_init)
     if args.netD != "":
         netD.load_state_dict(torch.load(args.netD))
 
+    # Networks used for the cGAN updates. With --compile these are compiled wrappers
+    # that share parameters with netG and netD. They only ever see full batches
+    # (drop_last) under autocast, so a single graph is captured. The fixed-noise
+    # samples, the evaluations and the classifier phase call the eager modules, so
+    # their other batch sizes and precisions do not trigger recompiles.
+    trainG, trainD = netG, netD
+    if args.compile:
+        torch.set_float32_matmul_precision("high")
+        trainG = torch.compile(netG, mode="reduce-overhead")
+        trainD = torch.compile(netD, mode="reduce-overhead")
+
     # Tensorboard writer.
     writer = SummaryWriter(log_dir=args.logdir, flush_secs=10)
+    scalars = utils.ScalarBuffer(
+        writer,
+        ["Loss/D", "Loss/G", "Probability/D(x)", "Probability/D(G(z))"],
+        args.save_frequency,
+        device,
+    )
 
     # GAN loss and labels.
-    criterion = nn.BCELoss()
-    real_label = 1
-    fake_label = 0
+    criterion = nn.BCEWithLogitsLoss()
+    real_labels = torch.ones(args.batch_size, device=device)
+    fake_labels = torch.zeros(args.batch_size, device=device)
+
+    # Mixed precision for the cGAN updates on GPU.
+    use_amp = device == "cuda"
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
 
     # Setup optimizers.
     optimizerD = optim.Adam(netD.parameters(), lr=args.lr, betas=(args.beta1, 0.999))
@@ -77,85 +111,104 @@ def main(args):
     one_hot_labels = torch.nn.functional.one_hot(labels).to(device)
     fixed_fake_conditional_noise = torch.cat((noise, one_hot_labels.float()), dim=1)
 
+    # One-hot encodings of every class, indexed by label inside the training loops.
+    one_hot_lookup = torch.eye(dataset.num_classes, device=device)
+
+    # Generator input, refilled in place with fresh noise and the one-hot labels at
+    # every step.
+    conditional_noise_buffer = torch.empty(
+        args.batch_size, args.nz + dataset.num_classes, device=device
+    )
+
+    # Image metrics, reset before every evaluation so that the Inception network is
+    # only loaded once.
+    is_ = torchmetrics.IS().to(device)
+    fid = torchmetrics.FID().to(device)
+    kid = torchmetrics.KID(subset_size=args.batch_size).to(device)
+
     if args.dry_run:
         args.niter = 1
 
+    # Futures of the sample grid and checkpoints being written in the background.
+    pending_saves = []
+
     for epoch in range(1, args.niter + 1):
         for i_step, (real_images, labels) in enumerate(dataloader):
-            # Create one hot labels for generator (one_hot_labels) and discriminator (image_one_hot_labels).
-            one_hot_labels = (
-                torch.nn.functional.one_hot(labels, num_classes=10).to(device).float()
-            )
-            image_one_hot_labels = one_hot_labels.clone()[..., None, None].expand(
-                -1, -1, 28, 28
-            )
+            # Create one hot labels for the generator and discriminator.
+            labels = labels.to(device, non_blocking=True)
+            one_hot_labels = one_hot_lookup[labels]
             #############################################################
             # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
             #############################################################
             # Train with real images.
-            netD.zero_grad()
-            real_images = real_images.to(device)
-            batch_size = real_images.shape[0]
-            label = torch.full(
-                (batch_size,), real_label, dtype=real_images.dtype, device=device
+            netD.zero_grad(set_to_none=True)
+            real_images = real_images.to(
+                device, non_blocking=True, memory_format=torch.channels_last
             )
-
-            output = netD(torch.cat((real_images, image_one_hot_labels), dim=1))
-            errD_real = criterion(output, label)
-            errD_real.backward()
-            D_x = output.mean().item()
+            batch_size = real_images.shape[0]
+            with torch.autocast("cuda", enabled=use_amp):
+                output = trainD(real_images, one_hot_labels)
+                errD_real = criterion(output, real_labels[:batch_size])
+            scaler.scale(errD_real).backward()
+            D_x = torch.sigmoid(output.detach()).mean()
 
             # Train with fake images.
-            noise = torch.randn(batch_size, args.nz, device=device).float()
-            conditional_noise = torch.cat((noise, one_hot_labels), dim=1)
-            fake_images = netG(conditional_noise)
-            label.fill_(fake_label)
-            output = netD(
-                torch.cat((fake_images.detach(), image_one_hot_labels), dim=1)
+            with torch.autocast("cuda", enabled=use_amp):
+                conditional_noise = conditional_noise_buffer[:batch_size]
+                conditional_noise[:, : args.nz].normal_()
+                conditional_noise[:, args.nz :].copy_(one_hot_labels)
+                fake_images = trainG(conditional_noise)
+                output = trainD(fake_images, one_hot_labels)
+                errD_fake = criterion(output, fake_labels[:batch_size])
+            scaler.scale(errD_fake).backward(
+                retain_graph=True, inputs=list(netD.parameters())
             )
-            errD_fake = criterion(output, label)
-            errD_fake.backward()
-            D_G_z1 = output.mean().item()
+            D_G_z = torch.sigmoid(output.detach()).mean()
             errD = errD_real + errD_fake
-            optimizerD.step()
 
             #############################################################
             # (2) Update G network: maximize log(D(G(z)))
             #############################################################
-            netG.zero_grad()
-            label.fill_(real_label)  # fake labels are real for generator cost
-            output = netD(torch.cat((fake_images, image_one_hot_labels), dim=1))
-            errG = criterion(output, label)
-            errG.backward()
-            D_G_z2 = output.mean().item()
-            optimizerG.step()
+            netG.zero_grad(set_to_none=True)
+            # Reuse the discriminator output on the fake images. Its backward has to run
+            # before optimizerD.step() updates the weights saved in the graph.
+            with torch.autocast("cuda", enabled=use_amp):
+                # Fake labels are real for generator cost.
+                errG = criterion(output, real_labels[:batch_size])
+            scaler.scale(errG).backward(inputs=list(netG.parameters()))
+            scaler.step(optimizerD)
+            scaler.step(optimizerG)
+            scaler.update()
 
             # Log to tensorboard.
-            current_iter = (epoch - 1) * len(dataloader) + i_step
-            writer.add_scalar("Loss/D", errD.item(), current_iter)
-            writer.add_scalar("Loss/G", errG.item(), current_iter)
-            writer.add_scalar("Probability/D(x)", D_x, current_iter)
-            writer.add_scalar("Probability/D(G(z_1))", D_G_z1, current_iter)
-            writer.add_scalar("Probability/D(G(z_2))", D_G_z2, current_iter)
+            current_iter = (epoch - 1) * steps_per_epoch + i_step
+            scalars.add(current_iter, errD, errG, D_x, D_G_z)
 
             # Save model with visual images.
             if i_step % args.save_frequency == 0:
+                # Raise any error from the previous background save.
+                for future in pending_saves:
+                    future.result()
+                pending_saves = []
+
+                loss_D, loss_G, D_x, D_G_z = scalars.flush()
                 print(
-                    f"[{epoch}/{args.niter}][{i_step:>3}/{len(dataloader)}] ({current_iter:>4})   Loss_D: {errD.item():.3f}"
-                    + f"   Loss_G {errG.item():.3f}   D(x): {D_x:.3f}   D(g(z)): {D_G_z1:.3f} -> {D_G_z2:.3f}"
+                    f"[{epoch}/{args.niter}][{i_step:>3}/{steps_per_epoch}] ({current_iter:>4})   Loss_D: {loss_D:.3f}"
+                    + f"   Loss_G {loss_G:.3f}   D(x): {D_x:.3f}   D(g(z)): {D_G_z:.3f}"
                 )
 
                 # Compute image metrics.
-                real_images = utils.prepare_data_for_inception(real_images, device)
-                fake_images = utils.prepare_data_for_inception(fake_images, device)
-                is_ = torchmetrics.IS().to(device)
-                fid = torchmetrics.FID().to(device)
-                kid = torchmetrics.KID(subset_size=args.batch_size).to(device)
-                is_.update(fake_images)
-                fid.update(real_images, real=True)
-                fid.update(fake_images, real=False)
-                kid.update(real_images, real=True)
-                kid.update(fake_images, real=False)
+                is_.reset()
+                fid.reset()
+                kid.reset()
+                with torch.no_grad():
+                    real_images = utils.prepare_data_for_inception(real_images, device)
+                    fake_images = utils.prepare_data_for_inception(fake_images, device)
+                    is_.update(fake_images)
+                    fid.update(real_images, real=True)
+                    fid.update(fake_images, real=False)
+                    kid.update(real_images, real=True)
+                    kid.update(fake_images, real=False)
                 writer.add_scalar("Metric/IS", is_.compute()[0].item(), current_iter)
                 writer.add_scalar("Metric/FID", fid.compute().item(), current_iter)
                 writer.add_scalar("Metric/KID", kid.compute()[0].item(), current_iter)
@@ -165,20 +218,34 @@ def main(args):
 
                 fakes = netG(fixed_fake_conditional_noise)
 
-                vutils.save_image(
-                    fakes.detach(),
-                    f"{path}/iteration{i_step}.png",
-                    nrow=10,
-                    normalize=True,
+                pending_saves.append(
+                    _saver.submit(
+                        vutils.save_image,
+                        fakes.detach().cpu(),
+                        f"{path}/iteration{i_step}.png",
+                        nrow=10,
+                        normalize=True,
+                    )
                 )
 
                 # Do checkpointing.
-                torch.save(netG.state_dict(), f"{path}/netG.pth")
-                torch.save(netD.state_dict(), f"{path}/netD.pth")
+                for name, net in [("netG", netG), ("netD", netD)]:
+                    pending_saves.append(
+                        _saver.submit(
+                            torch.save,
+                            utils.state_dict_to_cpu(net),
+                            f"{path}/{name}.pth",
+                        )
+                    )
 
             if args.dry_run:
                 break
 
+    scalars.flush()
+    for future in pending_saves:
+        future.result()
+    _saver.shutdown()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -211,6 +278,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--beta1", type=float, default=0.5, help="beta1 for adam. default=0.5"
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="compile netG and netD with torch.compile",
+    )
     parser.add_argument(
         "--dry-run", action="store_true", help="check a single training cycle works"
     )